@@ -0,0 +1,90 @@
+import os
+import shutil
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "200"))                        # Задач в очереди и в работе
+MAX_QUEUED_BYTES = int(os.getenv("MAX_QUEUED_BYTES", str(8*1024*1024*1024)))      # Оценка объёма всех задач
+USER_MAX_QUEUED_JOBS = int(os.getenv("USER_MAX_QUEUED_JOBS", "50"))               # То же на одного пользователя
+USER_MAX_QUEUED_BYTES = int(os.getenv("USER_MAX_QUEUED_BYTES", str(2*1024*1024*1024)))
+MIN_FREE_DISK = int(os.getenv("MIN_FREE_DISK", str(1024*1024*1024)))              # Запас свободного места
+DEFAULT_DURATION = int(os.getenv("DEFAULT_DURATION", "600"))  # Длительность видео, если она неизвестна, сек
+
+# Исходная дорожка ≤128 kbps и MP3 128 kbps лежат на диске одновременно
+BYTES_PER_SECOND = 2 * 128 * 1000 // 8
+
+
+def estimate_job_bytes(duration=None):
+    """Оценка места на диске для задачи по длительности видео"""
+    return int((duration or DEFAULT_DURATION) * BYTES_PER_SECOND)
+
+
+class AdmissionController:
+    """Допуск задач в очередь скачивания: общие и пользовательские лимиты по числу и объёму"""
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.jobs = 0
+        self.bytes = 0
+        self.user_jobs = {}
+        self.user_bytes = {}
+        self.rejected = 0
+        os.makedirs(workspace, exist_ok=True)
+
+    def try_admit(self, user_id, estimated_bytes):
+        """Учесть задачу. Возвращает None, если задача принята, иначе причину отказа"""
+        reason = None
+        if self.jobs >= MAX_QUEUED_JOBS or self.bytes + estimated_bytes > MAX_QUEUED_BYTES:
+            reason = "очередь переполнена, попробуйте позже"
+        elif (self.user_jobs.get(user_id, 0) >= USER_MAX_QUEUED_JOBS
+                or self.user_bytes.get(user_id, 0) + estimated_bytes > USER_MAX_QUEUED_BYTES):
+            reason = "слишком много ваших ссылок уже в очереди"
+        elif not self.disk_fits(estimated_bytes):
+            reason = "недостаточно места на диске, попробуйте позже"
+
+        if reason:
+            self.rejected += 1
+            logger.warning("Задача пользователя %s отклонена: %s", user_id, reason)
+            return reason
+
+        self.jobs += 1
+        self.bytes += estimated_bytes
+        self.user_jobs[user_id] = self.user_jobs.get(user_id, 0) + 1
+        self.user_bytes[user_id] = self.user_bytes.get(user_id, 0) + estimated_bytes
+        return None
+
+    def release(self, user_id, estimated_bytes):
+        """Задача завершена (успешно или нет)"""
+        self.jobs -= 1
+        self.bytes -= estimated_bytes
+        self.user_jobs[user_id] -= 1
+        self.user_bytes[user_id] -= estimated_bytes
+        if not self.user_jobs[user_id]:
+            del self.user_jobs[user_id]
+            del self.user_bytes[user_id]
+
+    def adjust(self, user_id, old_bytes, new_bytes):
+        """Уточнить оценку принятой задачи, когда стала известна реальная длительность"""
+        self.bytes += new_bytes - old_bytes
+        self.user_bytes[user_id] += new_bytes - old_bytes
+        if new_bytes > old_bytes and self.free_disk() - self.bytes < MIN_FREE_DISK:
+            logger.warning("Задача пользователя %s оказалась больше оценки: "
+                           "%d байт вместо %d, места на диске впритык", user_id, new_bytes, old_bytes)
+
+    def disk_fits(self, estimated_bytes):
+        """Хватит ли места на ещё estimated_bytes с учётом уже принятых задач"""
+        return self.free_disk() - self.bytes - estimated_bytes >= MIN_FREE_DISK
+
+    def free_disk(self):
+        return shutil.disk_usage(self.workspace).free
+
+    def gauges(self):
+        """Текущее состояние очереди для статистики"""
+        return {
+            'jobs': self.jobs,
+            'bytes': self.bytes,
+            'users': len(self.user_jobs),
+            'rejected': self.rejected,
+            'free_disk': self.free_disk(),
+        }
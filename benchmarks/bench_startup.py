@@ -0,0 +1,120 @@
+"""Время запуска бота до первого обработанного обновления
+
+Запуск: python benchmarks/bench_startup.py [число запусков]
+Бот стартует отдельным процессом в режиме polling против локальной заглушки Bot API
+(BOT_API_URL), которая отдаёт одно обновление /ping. Замер берётся из строк лога бота
+и дополнительно снаружи - от запуска процесса до ответа на /ping.
+"""
+import asyncio
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+READY_RE = re.compile(r"запускается \(([\d.]+) с после старта\)")
+FIRST_UPDATE_RE = re.compile(r"Первое обновление обработано через ([\d.]+) с")
+
+
+def make_fake_bot_api(replied):
+    """Заглушка Bot API: одно обновление /ping, дальше пустой long polling"""
+    pending = [{
+        "update_id": 1,
+        "message": {
+            "message_id": 1, "date": int(time.time()), "text": "/ping",
+            "chat": {"id": 7, "type": "private"},
+            "from": {"id": 7, "is_bot": False, "first_name": "user"},
+        },
+    }]
+
+    async def handle(request):
+        method = request.match_info["method"]
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            if pending:
+                result = [pending.pop()]
+            else:
+                await asyncio.sleep(0.5)
+                result = []
+        elif method == "sendMessage":
+            data = await request.post()
+            replied.set()
+            result = {
+                "message_id": 2, "date": 0,
+                "chat": {"id": int(data["chat_id"]), "type": "private"},
+                "text": data["text"],
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+async def run_once():
+    replied = asyncio.Event()
+    runner = web.AppRunner(make_fake_bot_api(replied))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(
+            os.environ,
+            BOT_TOKEN="123456:bench",
+            ADMIN_ID="1",
+            BOT_MODE="polling",
+            BOT_API_URL=f"http://{host}:{port}",
+            DATA_DIR=tmp,
+            DOWNLOAD_DIR=os.path.join(tmp, "downloads"),
+            LOG_FILE=os.path.join(tmp, "bot.log"),
+            PYTHONUNBUFFERED="1",
+        )
+        env.pop("CACHE_CHAT_ID", None)
+        started = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(ROOT, "bot.py"),
+            cwd=tmp, env=env, stderr=asyncio.subprocess.PIPE,
+        )
+        ready = first_update = None
+        try:
+            while first_update is None:
+                line = await asyncio.wait_for(proc.stderr.readline(), 60)
+                if not line:
+                    raise RuntimeError("Бот завершился до первого обновления")
+                line = line.decode("utf-8", "replace")
+                if match := READY_RE.search(line):
+                    ready = float(match.group(1))
+                if match := FIRST_UPDATE_RE.search(line):
+                    first_update = float(match.group(1))
+            await asyncio.wait_for(replied.wait(), 60)
+            replied_after = time.monotonic() - started
+        finally:
+            proc.terminate()
+            await proc.wait()
+            await runner.cleanup()
+    return ready, first_update, replied_after
+
+
+async def main():
+    results = [await run_once() for _ in range(RUNS)]
+    for name, values in zip(
+        ("Готов к работе (лог)", "Первое обновление (лог)", "Ответ на /ping (снаружи)"),
+        zip(*results),
+    ):
+        print(f"{name}: медиана {statistics.median(values):.2f} с, "
+              f"мин {min(values):.2f} с, макс {max(values):.2f} с")
+    print(f"Запусков: {RUNS}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+"""Стоимость подготовки YoutubeDL на одну задачу: новый экземпляр против тёплого из tools._get_ydl()
+
+Запуск: python benchmarks/bench_ydl_setup.py [число задач]
+Сеть не нужна: меряется только создание экземпляра и загрузка экстракторов YouTube.
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tools  # noqa: E402
+from yt_dlp import YoutubeDL  # noqa: E402
+
+JOBS = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+
+
+def prepare(ydl):
+    # То, что extract_info делает до первого сетевого запроса
+    ydl.get_info_extractor('Youtube')
+    ydl.get_info_extractor('YoutubeTab')
+    ydl.cache.load('youtube-sigfuncs', 'bench')
+
+
+def per_job():
+    start = time.perf_counter()
+    for _ in range(JOBS):
+        with YoutubeDL(dict(tools.YDL_OPTS)) as ydl:
+            prepare(ydl)
+    return (time.perf_counter() - start) / JOBS
+
+
+def warm():
+    tools._reset_ydl()
+    prepare(tools._get_ydl())  # Первая задача потока создаёт экземпляр
+    start = time.perf_counter()
+    for _ in range(JOBS):
+        prepare(tools._get_ydl())
+    elapsed = (time.perf_counter() - start) / JOBS
+    tools._reset_ydl()
+    return elapsed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        tools.YDL_OPTS['cachedir'] = cache_dir
+        tools.YDL_OPTS['quiet'] = True
+        # Прогрев импортов, чтобы не мерить их в первом замере
+        with YoutubeDL(dict(tools.YDL_OPTS)) as ydl:
+            prepare(ydl)
+        cold = per_job()
+        hot = warm()
+    print(f"Задач: {JOBS}")
+    print(f"Новый YoutubeDL на задачу: {cold * 1000:.2f} мс")
+    print(f"Тёплый YoutubeDL потока:   {hot * 1000:.3f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,63 @@
 import asyncio
+import atexit
+import contextlib
 import logging
+import logging.handlers
 import os
+import queue
 import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Отсчёт времени запуска - до импорта aiogram и остальных зависимостей
+STARTED_AT = time.monotonic()
+
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+from aiogram import Bot, Dispatcher, BaseMiddleware, types
 from aiogram.filters import CommandStart, Command, BaseFilter, and_f
 from aiogram.utils.markdown import hbold
 from aiogram.types import FSInputFile
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from tools import get_audio
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from tools import DOWNLOAD_DIR, MAX_SIZE, DownloadCancelled, get_audio, get_playlist_entries, is_playlist_url, get_job_dir, cleanup_job_dir, cleanup_stale_job_dirs, preload, close_all_ydl
 import database
+from admission import AdmissionController, MAX_QUEUED_JOBS, estimate_job_bytes
 
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 
+BOT_MODE = os.getenv("BOT_MODE", "polling")              # polling или webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")   # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "32"))  # Одновременно обрабатываемые обновления
+
+BOT_API_URL = os.getenv("BOT_API_URL")  # Свой telegram-bot-api, например http://telegram-bot-api:8081
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0") == "1"  # Сервер запущен с --local и видит наши файлы
+UPLOAD_TIMEOUT = int(os.getenv("UPLOAD_TIMEOUT", "600"))  # Таймаут отправки аудио, сек
+
+# Предзагрузка популярных видео: обновляет кэш, загружая их в служебный чат
+CACHE_CHAT_ID = os.getenv("CACHE_CHAT_ID")                             # Без него предзагрузка выключена
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", "60"))         # Пауза между проверками, сек
+PREFETCH_WINDOW_DAYS = int(os.getenv("PREFETCH_WINDOW_DAYS", "7"))    # Окно подсчёта популярности
+PREFETCH_MIN_REQUESTS = int(os.getenv("PREFETCH_MIN_REQUESTS", "3"))  # Сколько запросов делает видео популярным
+CACHE_REFRESH_DAYS = int(os.getenv("CACHE_REFRESH_DAYS", "30"))       # Возраст кэша, после которого он обновляется
+PREFETCH_RETRY_DELAY = 24*3600  # Через сколько секунд повторять неудавшуюся предзагрузку
+
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10*1024*1024)))  # Размер файла лога до ротации
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "3"))
+
 # Валидация переменных .env
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не установлен!")
@@ -28,25 +69,108 @@ try:
 except (ValueError, TypeError):
     raise ValueError(f"ADMIN_ID должен быть числом, получено: {ADMIN_ID}")
 
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError(f"BOT_MODE должен быть polling или webhook, получено: {BOT_MODE}")
+if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+    raise ValueError("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET!")
+if BOT_API_LOCAL and not BOT_API_URL:
+    raise ValueError("BOT_API_LOCAL=1 работает только вместе с BOT_API_URL!")
+# Иначе файлы больше лимита не режутся на части и каждая такая отправка падает
+if MAX_SIZE > 2000*1024*1024:
+    raise ValueError(f"MAX_UPLOAD_SIZE не может быть больше 2000 МБ, получено: {MAX_SIZE}")
+if MAX_SIZE > 50*1024*1024 and not BOT_API_URL:
+    raise ValueError("MAX_UPLOAD_SIZE больше 50 МБ работает только вместе с BOT_API_URL!")
+
+if CACHE_CHAT_ID:
+    try:
+        CACHE_CHAT_ID = int(CACHE_CHAT_ID)
+    except ValueError:
+        raise ValueError(f"CACHE_CHAT_ID должен быть числом, получено: {CACHE_CHAT_ID}")
+
 
 YOUTUBE_REGEX = re.compile(
     r"(https?://(?:www\.)?(?:youtube\.com|youtu\.be)/[^\s]+)"
 )
 
-download_queue = asyncio.Queue()
-processing_task: asyncio.Task | None = None
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "2"))             # Параллельные скачивания
+PROGRESS_EDIT_INTERVAL = float(os.getenv("PROGRESS_EDIT_INTERVAL", "3"))  # Секунды между правками статуса
+JOB_DIR_SWEEP_INTERVAL = 3600  # Как часто удалять брошенные рабочие директории, сек
+
+# Свой пул потоков для get_audio: у каждого потока один долгоживущий YoutubeDL
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="download")
+
+# Размер очереди ограничен: задачи сначала проходят допуск в admission
+download_queue = asyncio.Queue(maxsize=MAX_QUEUED_JOBS)
+admission = AdmissionController(DOWNLOAD_DIR)
+processing_tasks: list[asyncio.Task] = []
+prefetch_task: asyncio.Task | None = None
+sweep_task: asyncio.Task | None = None
+prefetch_failures: dict[str, float] = {}  # url -> время неудачной предзагрузки
+url_locks: dict[str, list] = {}  # url -> [asyncio.Lock, число ожидающих задач]
+status_edit_times: dict[int, float] = {}  # chat_id -> время последней правки статуса
 
 # Логи
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s | %(levelname)s | %(message)s",
-    handlers=[logging.StreamHandler(), logging.FileHandler("bot.log", encoding="utf-8")]
-)
+def setup_logging() -> logging.handlers.QueueListener:
+    """Запись логов в фоновом потоке: цикл событий только кладёт записи в очередь"""
+    formatter = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+    )
+    handlers = [logging.StreamHandler(), file_handler]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
 
-bot = Bot(token=BOT_TOKEN)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Дописать оставшиеся в очереди записи при выходе
+    atexit.register(listener.stop)
+    return listener
+
+
+setup_logging()
+
+session = None
+if BOT_API_URL:
+    session = AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL))
+bot = Bot(token=BOT_TOKEN, session=session)
 dp = Dispatcher()
 
 
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничение числа одновременно обрабатываемых обновлений"""
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self.semaphore:
+            return await handler(event, data)
+
+
+class StartupTimerMiddleware(BaseMiddleware):
+    """Время от запуска процесса до первого обработанного обновления"""
+
+    def __init__(self):
+        self.preload_task: asyncio.Task | None = None
+
+    async def __call__(self, handler, event, data):
+        result = await handler(event, data)
+        if self.preload_task is None:
+            logging.info(f"Первое обновление обработано через {time.monotonic() - STARTED_AT:.2f} с после запуска")
+            # Зависимости скачивания подгружаем, когда бот уже отвечает
+            self.preload_task = asyncio.create_task(asyncio.to_thread(preload))
+        return result
+
+
+dp.update.outer_middleware(StartupTimerMiddleware())
+dp.update.outer_middleware(ConcurrencyLimitMiddleware(HANDLER_CONCURRENCY))
+
+
 def get_cover_thumbnail():
     """Обложка для аудио"""
     cover_paths = ["cover.png", "cover.jpeg"]
@@ -55,6 +179,12 @@ def get_cover_thumbnail():
             return FSInputFile(cover_path)
     return None
 
+def get_upload_file(path: str):
+    """Аудио для отправки: локальный Bot API читает файл с диска сам, без загрузки по HTTP"""
+    if BOT_API_LOCAL:
+        return Path(path).resolve().as_uri()
+    return FSInputFile(path)
+
 class AuthorizedUserFilter(BaseFilter):
     async def __call__(self, message: types.Message) -> bool:
         return await database.is_user_registered(message.from_user.id)
@@ -172,6 +302,8 @@ async def cmd_stats(message: types.Message):
     total_size_mb = stats['total_size'] / (1024 * 1024) if stats['total_size'] else 0
     total_requests = stats.get('total_requests', 0)
     savings = total_requests - stats['total_downloads'] if total_requests > 0 else 0
+    queue_stats = admission.gauges()
+    queued = download_queue.qsize()
     text = (
         f"<b>Статистика бота:</b>\n\n"
         f"Всего пользователей: {stats['total_users']}\n"
@@ -180,7 +312,13 @@ async def cmd_stats(message: types.Message):
         f"Уникальных видео скачано: {stats['total_downloads']}\n"
         f"Уникальных видео в кэше: {stats['unique_videos']}\n"
         f"Экономия: {savings} скачиваний из кэша\n"
-        f"Общий размер: {total_size_mb:.2f} МБ"
+        f"Общий размер: {total_size_mb:.2f} МБ\n\n"
+        f"<b>Очередь:</b>\n"
+        f"Ожидают: {queued}, в работе: {queue_stats['jobs'] - queued}\n"
+        f"Пользователей в очереди: {queue_stats['users']}\n"
+        f"Оценка объёма задач: {queue_stats['bytes'] / (1024 * 1024):.0f} МБ\n"
+        f"Свободно на диске: {queue_stats['free_disk'] / (1024 ** 3):.1f} ГБ\n"
+        f"Отклонено задач: {queue_stats['rejected']}"
     )
     await message.answer(text, parse_mode="HTML")
 
@@ -214,123 +352,340 @@ async def handle_links(message: types.Message):
         if is_valid:
             valid_urls.append(url)
         else:
-            logging.warning(f"Пропущен некорректный URL: {url}")
+            logging.warning("Пропущен некорректный URL: %s", url)
     
     if not valid_urls:
         await message.answer("Не найдено валидных ссылок на YouTube.")
         return
 
+    await record_requests([url for url in valid_urls if not is_playlist_url(url)])
+
+    rejected = []
     for url in valid_urls:
-        await download_queue.put((message, url))
+        if is_playlist_url(url):
+            await handle_playlist(message, url)
+            continue
+        reason = enqueue_download(message, url)
+        if reason:
+            rejected.append(reason)
+
+    if rejected:
+        await message.answer(
+            f"Не принято ссылок: {len(rejected)} из {len(valid_urls)} - {rejected[-1]}."
+        )
+    ensure_workers()
+
+
+async def record_requests(urls: list[str]):
+    """Учёт запросов ссылок для популярности (ошибка не мешает скачиванию)"""
+    # История нужна только предзагрузке, а чистит её только prefetcher
+    if not CACHE_CHAT_ID:
+        return
+    try:
+        await database.record_video_requests(urls)
+    except Exception as e:
+        logging.warning("Failed to record video requests: %s", e)
+
+
+def enqueue_download(message: types.Message, url: str, batch=None, duration: int | None = None) -> str | None:
+    """Постановка в очередь через допуск. Возвращает причину отказа или None"""
+    estimated_bytes = estimate_job_bytes(duration)
+    reason = admission.try_admit(message.from_user.id, estimated_bytes)
+    if not reason:
+        download_queue.put_nowait((message, url, batch, estimated_bytes))
+    return reason
+
+
+async def run_download(*args):
+    """get_audio в пуле потоков скачивания"""
+    return await asyncio.get_running_loop().run_in_executor(download_executor, get_audio, *args)
+
+
+def ensure_workers():
+    """Запуск пула воркеров, если он ещё не запущен"""
+    processing_tasks[:] = [task for task in processing_tasks if not task.done()]
+    while len(processing_tasks) < DOWNLOAD_WORKERS:
+        processing_tasks.append(asyncio.create_task(worker()))
+
+
+async def edit_status(status: types.Message, text: str, force: bool = False) -> bool:
+    """Правка статус-сообщения не чаще PROGRESS_EDIT_INTERVAL на чат. False - если пропущена"""
+    now = time.monotonic()
+    if not force and now - status_edit_times.get(status.chat.id, 0.0) < PROGRESS_EDIT_INTERVAL:
+        return False
+    # Записи старше интервала уже ничего не ограничивают - словарь не растёт без предела
+    for chat_id in [c for c, t in status_edit_times.items() if now - t >= PROGRESS_EDIT_INTERVAL]:
+        del status_edit_times[chat_id]
+    status_edit_times[status.chat.id] = now
+    try:
+        await status.edit_text(text)
+    except Exception as e:
+        logging.debug("Не удалось обновить статус-сообщение: %s", e)
+    return True
+
+
+class DownloadProgress:
+    """Прогресс из потока скачивания в статус-сообщение"""
+
+    def __init__(self, status: types.Message):
+        self.status = status
+        self.loop = asyncio.get_running_loop()
+        self.text = None
+        self._last_text = None
+
+    def __call__(self, text: str):
+        # Вызывается из потока скачивания - в цикл событий передаём потокобезопасно
+        self.loop.call_soon_threadsafe(setattr, self, 'text', text)
+
+    async def run(self):
+        """Периодическая правка статуса, пока задача не отменена"""
+        while True:
+            await asyncio.sleep(PROGRESS_EDIT_INTERVAL)
+            text = self.text
+            if text and text != self._last_text and await edit_status(self.status, text):
+                self._last_text = text
+
+
+class BatchProgress:
+    """Один статус-сообщение на весь плейлист, правится не чаще PROGRESS_EDIT_INTERVAL"""
+
+    def __init__(self, status: types.Message, title: str | None, total: int):
+        self.status = status
+        self.title = title or "Плейлист"
+        self.total = total
+        self.cached = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.reject_reason = None
+        self._last_text = None
+
+    @property
+    def finished(self) -> bool:
+        return self.cached + self.downloaded + self.failed + self.rejected >= self.total
+
+    def render(self) -> str:
+        done = self.cached + self.downloaded + self.failed + self.rejected
+        text = (
+            f"{self.title}\n"
+            f"Готово: {done}/{self.total}\n"
+            f"Из кэша: {self.cached}, скачано: {self.downloaded}"
+        )
+        if self.failed:
+            text += f", ошибок: {self.failed}"
+        if self.rejected:
+            text += f"\nНе принято в очередь: {self.rejected} ({self.reject_reason})"
+        return text
+
+    async def update(self, force: bool = False):
+        text = self.render()
+        if text != self._last_text and await edit_status(self.status, text, force):
+            self._last_text = text
+
+    async def item_finished(self, ok: bool):
+        if ok:
+            self.downloaded += 1
+        else:
+            self.failed += 1
+        await self.update(force=self.finished)
+
+
+async def get_or_create_db_user(message: types.Message) -> dict | None:
+    """Пользователь из БД (создаётся при отсутствии)"""
+    user_id = message.from_user.id
+    user_db = await database.get_user_by_telegram_id(user_id)
+    if user_db:
+        return user_db
+
+    full_name = message.from_user.full_name
+    username = message.from_user.username
+    db_user_id = await database.create_user(user_id, full_name, username)
+    if not db_user_id:
+        await message.answer("Ошибка: не удалось создать пользователя в базе данных.")
+        logging.error("Failed to create user %s in database", user_id)
+        return None
+    user_db = await database.get_user_by_telegram_id(user_id)
+    if not user_db:
+        await message.answer("Ошибка: пользователь не найден в базе данных.")
+    return user_db
+
+
+async def send_audio_with_retry(chat_id: int, audio, **kwargs) -> types.Message:
+    """send_audio с ожиданием при ограничении частоты (429) вместо ошибки"""
+    while True:
+        try:
+            return await bot.send_audio(chat_id, audio, **kwargs)
+        except TelegramRetryAfter as e:
+            logging.info("Flood control в чате %s, жду %s с", chat_id, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+
+
+async def send_cached_parts(chat_id: int, url: str, cached_parts: list[dict]) -> bool:
+    """Отправка аудио из кэша по file_id. False - если кэш устарел"""
+    total_parts = len(cached_parts)
+    logging.info("Processing %d cached parts for %s", total_parts, url)
+    try:
+        thumbnail = get_cover_thumbnail()
+        if total_parts == 1:
+            # Один файл
+            cached_video = cached_parts[0]
+            await send_audio_with_retry(
+                chat_id,
+                cached_video['file_id'],
+                title=cached_video.get('title'),
+                performer=cached_video.get('performer'),
+                thumbnail=thumbnail
+            )
+        else:
+            # Несколько частей
+            for part in cached_parts:
+                part_num = part.get('part_number', 1)
+                part_title = part.get('title', '')
+                if f"(часть {part_num})" not in part_title:
+                    title = f"{part_title} (часть {part_num})"
+                else:
+                    title = part_title
+                
+                await send_audio_with_retry(
+                    chat_id,
+                    part['file_id'],
+                    title=title,
+                    performer=part.get('performer'),
+                    thumbnail=thumbnail
+                )
+                logging.debug("Sending cached part %s/%d for %s", part_num, total_parts, url)
+        return True
+    except Exception as e:
+        logging.warning("Failed to send cached file_id, will re-download: %s", e)
+        return False
+
+
+async def handle_playlist(message: types.Message, url: str):
+    """Раскрытие плейлиста/канала: кэш отправляется сразу, остальное - в очередь"""
+    status = await message.answer("Получаю список видео...")
+    try:
+        playlist_title, video_urls = await asyncio.to_thread(get_playlist_entries, url)
+    except Exception as e:
+        logging.warning("Не удалось получить плейлист %s: %s", url, e)
+        await status.edit_text("Не удалось получить список видео плейлиста.")
+        return
+    if not video_urls:
+        await status.edit_text("Плейлист пуст или недоступен.")
+        return
+
+    user_db = await get_or_create_db_user(message)
+    if not user_db:
+        return
 
-    global processing_task
-    if not processing_task or processing_task.done():
-        processing_task = asyncio.create_task(worker())
+    await record_requests(list(video_urls))
+    cached = await database.get_videos_by_urls(list(video_urls))
+    logging.info("Playlist %s: %d/%d videos in cache", url, len(cached), len(video_urls))
+    batch = BatchProgress(status, playlist_title, len(video_urls))
+    await batch.update(force=True)
+
+    misses = []
+    for video_url in video_urls:
+        cached_parts = cached.get(video_url)
+        if cached_parts and await send_cached_parts(message.chat.id, video_url, cached_parts):
+            batch.cached += 1
+            try:
+                await database.increment_user_requests(user_db['id'])
+            except Exception as stats_error:
+                logging.warning("Failed to update stats: %s", stats_error)
+            await batch.update(force=batch.finished)
+        else:
+            misses.append(video_url)
+
+    for video_url in misses:
+        reason = enqueue_download(message, video_url, batch, video_urls[video_url])
+        if reason:
+            batch.rejected += 1
+            batch.reject_reason = reason
+    await batch.update(force=batch.finished)
 
 
 # Обработчик скачивания с кэшированием
-async def process_audio_download(message: types.Message, url: str):
+async def process_audio_download(message: types.Message, url: str, batch: BatchProgress | None = None,
+                                 on_duration=None) -> bool:
+    """Отправка аудио по ссылке (из кэша или со скачиванием). True - если аудио отправлено.
+    on_duration(seconds) вызывается из потока скачивания, когда известна длительность видео"""
+    async with url_lock(url):
+        return await _process_audio_download(message, url, batch, on_duration)
+
+
+@contextlib.asynccontextmanager
+async def url_lock(url: str):
+    """Одна и та же ссылка не скачивается параллельно: второй запрос дождётся кэша"""
+    entry = url_locks.setdefault(url, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del url_locks[url]
+
+
+async def _process_audio_download(message: types.Message, url: str, batch: BatchProgress | None,
+                                  on_duration=None) -> bool:
     user_id = message.from_user.id
     
-    user_db = await database.get_user_by_telegram_id(user_id)
+    user_db = await get_or_create_db_user(message)
     if not user_db:
-        full_name = message.from_user.full_name
-        username = message.from_user.username
-        db_user_id = await database.create_user(user_id, full_name, username)
-        if not db_user_id:
-            await message.answer("Ошибка: не удалось создать пользователя в базе данных.")
-            logging.error(f"Failed to create user {user_id} in database")
-            return
-        user_db = await database.get_user_by_telegram_id(user_id)
-        if not user_db:
-            await message.answer("Ошибка: пользователь не найден в базе данных.")
-            return
+        return False
     
     db_user_id = user_db['id']
     
     # Проверяем есть ли уже это видео в БД
     cached_parts = await database.get_video_by_url(url)
-    if cached_parts:
+    if not cached_parts:
+        logging.info("Cache MISS for %s: not found in database", url)
+    elif logging.getLogger().isEnabledFor(logging.INFO):
         part_numbers = [p.get('part_number', 0) for p in cached_parts]
-        logging.info(f"Cache HIT for {url}: found {len(cached_parts)} parts with numbers {part_numbers}")
-    else:
-        logging.info(f"Cache MISS for {url}: not found in database")
+        logging.info("Cache HIT for %s: found %d parts with numbers %s", url, len(cached_parts), part_numbers)
     
     if cached_parts:
         # Отправляем из кэша если есть
-        total_parts = len(cached_parts)
-        logging.info(f"Processing {total_parts} cached parts for {url}")
-        if total_parts == 1:
-            # Один файл
-            cached_video = cached_parts[0]
+        if await send_cached_parts(message.chat.id, url, cached_parts):
+            # Обновлие статистики
             try:
-                thumbnail = get_cover_thumbnail()
-                await bot.send_audio(
-                    message.chat.id,
-                    cached_video['file_id'],
-                    title=cached_video.get('title'),
-                    performer=cached_video.get('performer'),
-                    thumbnail=thumbnail
-                )
-                # Обновлие статистики
-                try:
-                    await database.increment_user_requests(db_user_id)
-                except Exception as stats_error:
-                    logging.warning(f"Failed to update stats: {stats_error}")
-                logging.info(f"Sent cached audio for {url} to user {user_id}")
-                return
-            except Exception as e:
-                logging.warning(f"Failed to send cached file_id, will re-download: {e}")
-                await message.answer(f"Кэш устарел, скачиваю заново...")
-        else:
-            # Несколько частей
-            try:
-                thumbnail = get_cover_thumbnail()
-                for part in cached_parts:
-                    part_num = part.get('part_number', 1)
-                    part_title = part.get('title', '')
-                    if f"(часть {part_num})" not in part_title:
-                        title = f"{part_title} (часть {part_num})"
-                    else:
-                        title = part_title
-                    
-                    await bot.send_audio(
-                        message.chat.id,
-                        part['file_id'],
-                        title=title,
-                        performer=part.get('performer'),
-                        thumbnail=thumbnail
-                    )
-                    logging.debug(f"Sending cached part {part_num}/{total_parts} for {url}")
-                # Обновление статистики
-                try:
-                    await database.increment_user_requests(db_user_id)
-                except Exception as stats_error:
-                    logging.warning(f"Failed to update stats: {stats_error}")
-                logging.info(f"Sent cached audio ({total_parts} parts) for {url} to user {user_id}")
-                return
-            except Exception as e:
-                logging.warning(f"Failed to send cached file_id, will re-download: {e}")
-                await message.answer(f"Кэш устарел, скачиваю заново...")
+                await database.increment_user_requests(db_user_id)
+            except Exception as stats_error:
+                logging.warning("Failed to update stats: %s", stats_error)
+            logging.info("Sent cached audio (%d parts) for %s to user %s", len(cached_parts), url, user_id)
+            return True
+        if not batch:
+            await message.answer(f"Кэш устарел, скачиваю заново...")
     
     # Видео нет в кэше или кэш не сработал. Скачиваем
-    status = await message.answer(f"Скачиваю аудио...")
-    files = None
+    # В пакетном режиме прогресс показывает общий статус плейлиста
+    status = None if batch else await message.answer(f"Скачиваю аудио...")
+    job_dir = get_job_dir(url)
+    sent = False
     
     try:
-        files, title, performer = await asyncio.to_thread(get_audio, url)
+        progress = DownloadProgress(status) if status else None
+        progress_task = asyncio.create_task(progress.run()) if progress else None
+        try:
+            files, title, performer = await run_download(url, job_dir, progress, None, on_duration)
+        finally:
+            if progress_task:
+                progress_task.cancel()
         if not files:
-            await status.edit_text("Ошибка при скачивании!")
-            return
+            if status:
+                await status.edit_text("Ошибка при скачивании!")
+            return False
 
         if len(files) == 1:
             thumbnail = get_cover_thumbnail()
-            sent_message = await bot.send_audio(
+            sent_message = await send_audio_with_retry(
                 message.chat.id,
-                FSInputFile(files[0]),
+                get_upload_file(files[0]),
                 title=title,
                 performer=performer,
-                thumbnail=thumbnail
+                thumbnail=thumbnail,
+                request_timeout=UPLOAD_TIMEOUT
             )
             # Сохраняем file_id для кэширования
             if sent_message.audio:
@@ -346,23 +701,21 @@ async def process_audio_download(message: types.Message, url: str):
                     part_number=1,
                     total_parts=1
                 )
-                logging.info(f"Saved video to cache: {url} -> {file_id}")
-            try:
-                await status.delete()
-            except Exception as e:
-                logging.debug(f"Не удалось удалить статус-сообщение: {e}")
+                logging.info("Saved video to cache: %s -> %s", url, file_id)
         else:
-            await status.edit_text("Файл большой, отправляю по частям...")
+            if status:
+                await status.edit_text("Файл большой, отправляю по частям...")
             total_parts = len(files)
             thumbnail = get_cover_thumbnail()
             # Сохраняем все части в кэш
             for i, f in enumerate(files, 1):
-                sent_message = await bot.send_audio(
+                sent_message = await send_audio_with_retry(
                     message.chat.id,
-                    FSInputFile(f),
+                    get_upload_file(f),
                     title=f"{title} (часть {i})",
                     performer=performer,
-                    thumbnail=thumbnail
+                    thumbnail=thumbnail,
+                    request_timeout=UPLOAD_TIMEOUT
                 )
                 # Сохраняем каждую часть в кэш
                 if sent_message.audio:
@@ -379,51 +732,242 @@ async def process_audio_download(message: types.Message, url: str):
                         total_parts=total_parts
                     )
                     if result > 0:
-                        logging.info(f"Saved video part {i}/{total_parts} to cache: {url} -> {file_id}")
+                        logging.info("Saved video part %d/%d to cache: %s -> %s", i, total_parts, url, file_id)
                     else:
-                        logging.info(f"Video part {i} already in cache, skipped: {url}")
+                        logging.info("Video part %d already in cache, skipped: %s", i, url)
                         if i == 1:
                             # Если первая часть уже в кэше, значит весь файл уже есть
                             break
+        if status:
             try:
                 await status.delete()
             except Exception as e:
-                logging.debug(f"Не удалось удалить статус-сообщение: {e}")
+                logging.debug("Не удалось удалить статус-сообщение: %s", e)
+        sent = True
+        return True
 
     except Exception as e:
         logging.exception("Ошибка обработки")
+        if not status:
+            return False
         try:
             await status.edit_text(f"Ошибка при скачивании или обработке аудио: {e}")
         except Exception as edit_error:
-            logging.debug(f"Не удалось обновить статус, отправляю новое сообщение: {edit_error}")
+            logging.debug("Не удалось обновить статус, отправляю новое сообщение: %s", edit_error)
             await message.answer(f"Ошибка при скачивании или обработке аудио: {e}")
+        return False
     finally:
-        # безопасная очистка временных файлов
-        if files:
-            for f in files:
-                if os.path.exists(f):
-                    try:
-                        os.remove(f)
-                    except Exception as cleanup_error:
-                        logging.warning(f"Не удалось удалить файл {f}: {cleanup_error}")
+        # безопасная очистка временных файлов; после ошибки .part-файлы
+        # остаются для докачки при следующем запросе этой ссылки
+        if sent:
+            await asyncio.to_thread(cleanup_job_dir, job_dir)
 
 
 async def worker():
     """Воркер для обработки очереди скачивания"""
+    loop = asyncio.get_running_loop()
     while True:
+        msg, url, batch, estimated_bytes = await download_queue.get()
+        user_id = msg.from_user.id
+
+        def correct_estimate(duration):
+            # Одиночные ссылки принимаются по DEFAULT_DURATION - уточняем по реальной длительности
+            nonlocal estimated_bytes
+            if estimated_bytes is None:
+                return
+            real_bytes = estimate_job_bytes(duration)
+            admission.adjust(user_id, estimated_bytes, real_bytes)
+            estimated_bytes = real_bytes
+
+        ok = False
         try:
-            msg, url = await download_queue.get()
-            await process_audio_download(msg, url)
-            download_queue.task_done()
+            ok = await process_audio_download(
+                msg, url, batch,
+                lambda duration: loop.call_soon_threadsafe(correct_estimate, duration)
+            )
         except Exception as e:
-            logging.exception(f"Ошибка в worker при обработке {url}: {e}")
+            logging.exception("Ошибка в worker при обработке %s: %s", url, e)
+        finally:
+            admission.release(user_id, estimated_bytes)
+            estimated_bytes = None
             download_queue.task_done()
+        if batch:
+            await batch.item_finished(ok)
+
+
+async def job_dir_sweeper():
+    """Периодическое удаление директорий неудавшихся задач старше JOB_DIR_TTL"""
+    while True:
+        await asyncio.sleep(JOB_DIR_SWEEP_INTERVAL)
+        try:
+            await asyncio.to_thread(cleanup_stale_job_dirs)
+        except Exception as e:
+            logging.exception("Ошибка при очистке рабочих директорий: %s", e)
+
+
+def queue_idle() -> bool:
+    """Нет пользовательских задач ни в очереди, ни в работе"""
+    return admission.jobs == 0
+
+
+async def prefetch_video(url: str, db_user_id: int) -> bool:
+    """Скачать видео и загрузить в служебный чат, обновив кэш. Прерывается при появлении задач"""
+    async with url_lock(url):
+        job_dir = get_job_dir(url)
+        too_big = False
+
+        def check_disk(duration):
+            # Перед стартом проверена оценка по DEFAULT_DURATION, здесь - по реальной длительности
+            nonlocal too_big
+            too_big = not admission.disk_fits(estimate_job_bytes(duration))
+
+        try:
+            # cancel вызывается из потока скачивания: чтение счётчика задач безопасно
+            files, title, performer = await run_download(
+                url, job_dir, None, lambda: too_big or not queue_idle(), check_disk
+            )
+        except DownloadCancelled:
+            if too_big:
+                logging.info("Предзагрузка %s пропущена: не хватает места на диске", url)
+                prefetch_failures[url] = time.monotonic()
+                await asyncio.to_thread(cleanup_job_dir, job_dir)
+            # Иначе .part остаётся в job_dir, следующая попытка докачает
+            return False
+        if not files:
+            prefetch_failures[url] = time.monotonic()
+            return False
+
+        # Загрузка идёт уже без блокировки ссылки, чтобы пользовательский запрос её не ждал,
+        # поэтому файлы забираем из общей job_dir в отдельную директорию
+        upload_dir = f"{job_dir}.upload"
+
+        def take_files():
+            cleanup_job_dir(upload_dir)
+            os.rename(job_dir, upload_dir)
+            os.utime(upload_dir)  # Не попасть под cleanup_stale_job_dirs во время загрузки
+
+        await asyncio.to_thread(take_files)
+
+    files = [os.path.join(upload_dir, os.path.basename(f)) for f in files]
+    try:
+        parts = []
+        for i, f in enumerate(files, 1):
+            if not queue_idle():
+                # Уже загруженные в служебный чат части просто не попадут в кэш
+                logging.info("Предзагрузка %s прервана перед загрузкой части %d: появились задачи", url, i)
+                return False
+            sent_message = await send_audio_with_retry(
+                CACHE_CHAT_ID,
+                get_upload_file(f),
+                title=title if len(files) == 1 else f"{title} (часть {i})",
+                performer=performer,
+                thumbnail=get_cover_thumbnail(),
+                disable_notification=True,
+                request_timeout=UPLOAD_TIMEOUT
+            )
+            if not sent_message.audio:
+                raise RuntimeError("Telegram не вернул audio")
+            parts.append((sent_message.audio.file_id, sent_message.audio.file_size))
+        await database.replace_video(url, db_user_id, parts, title=title, performer=performer)
+    except Exception as e:
+        logging.warning("Предзагрузка %s не удалась: %s", url, e)
+        prefetch_failures[url] = time.monotonic()
+        return False
+    finally:
+        await asyncio.to_thread(cleanup_job_dir, upload_dir)
+    return True
+
+
+async def prefetcher():
+    """Фоновое обновление популярных записей кэша, пока нет пользовательских задач"""
+    admin_db = None
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL)
+        try:
+            # История чистится и под нагрузкой, иначе при постоянной очереди таблица растёт без предела
+            await database.prune_video_requests(PREFETCH_WINDOW_DAYS)
+            if not queue_idle():
+                continue
+            if admin_db is None:
+                # Записи кэша требуют пользователя - предзагрузка идёт от имени администратора.
+                # create_user перезаписал бы имя и username, поэтому только если записи ещё нет
+                admin_db = await database.get_user_by_telegram_id(ADMIN_ID)
+                if admin_db is None:
+                    await database.create_user(ADMIN_ID)
+                    admin_db = await database.get_user_by_telegram_id(ADMIN_ID)
+            candidates = await database.get_prefetch_candidates(
+                PREFETCH_WINDOW_DAYS, PREFETCH_MIN_REQUESTS, CACHE_REFRESH_DAYS, limit=20
+            )
+            now = time.monotonic()
+            for url in candidates:
+                # Предзагрузка не занимает место, нужное пользовательским задачам
+                if not queue_idle() or not admission.disk_fits(estimate_job_bytes()):
+                    break
+                # Недоступные видео не пытаемся качать каждый цикл
+                failed_at = prefetch_failures.get(url)
+                if failed_at is not None and now - failed_at < PREFETCH_RETRY_DELAY:
+                    continue
+                if await prefetch_video(url, admin_db['id']):
+                    prefetch_failures.pop(url, None)
+                    logging.info("Предзагружено популярное видео %s", url)
+        except Exception as e:
+            logging.exception("Ошибка в prefetcher: %s", e)
+
+
+def create_webhook_app() -> web.Application:
+    """aiohttp-приложение, принимающее обновления от Telegram с проверкой секрета"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook():
+    """Режим webhook: несколько реплик бота можно поставить за балансировщиком"""
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    # Очередь обновлений не сбрасываем: её могут обрабатывать другие реплики
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logging.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
 
 
 async def main():
-    await database.init_db()
-    logging.info("Бот запускается...")
-    await dp.start_polling(bot, skip_updates=True)
+    # Шаги запуска независимы - выполняем их одновременно
+    _, me, _ = await asyncio.gather(
+        database.init_db(),
+        bot.get_me(),
+        asyncio.to_thread(cleanup_stale_job_dirs)
+    )
+    logging.info(f"Бот @{me.username} запускается ({time.monotonic() - STARTED_AT:.2f} с после старта)...")
+    global prefetch_task, sweep_task
+    sweep_task = asyncio.create_task(job_dir_sweeper())
+    if CACHE_CHAT_ID:
+        prefetch_task = asyncio.create_task(prefetcher())
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Если раньше был установлен webhook, getUpdates с ним не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot, skip_updates=True)
+    finally:
+        download_executor.shutdown(wait=False, cancel_futures=True)
+        close_all_ydl()
 
 
 if __name__ == "__main__":
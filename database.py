@@ -1,7 +1,7 @@
 import aiosqlite
 import logging
 from datetime import datetime
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Dict
 
 import os
 
@@ -79,6 +79,19 @@ async def init_db():
             except aiosqlite.OperationalError:
                 pass
 
+            # История запросов по ссылкам (для популярности и предзагрузки)
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS video_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                youtube_url TEXT NOT NULL,
+                requested_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+            """)
+
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_video_requests_time ON video_requests(requested_at, youtube_url)
+            """)
+
 
             try:
                 await db.execute("""
@@ -173,6 +186,50 @@ async def get_all_users() -> List[dict]:
 
 
 
+def _collect_parts(youtube_url: str, rows: List[dict]) -> Optional[List[dict]]:
+    """Собрать части самой свежей загрузки из строк таблицы videos"""
+    if not rows:
+        logging.debug("Cache miss for %s: no records found", youtube_url)
+        return None
+
+    # Собираем все уникальные части (берем самую свежую версию каждой части)
+    # Группируем по part_number и берем самую свежую запись для каждой части
+    parts_by_number = {}
+    for row_dict in rows:
+        part_num = row_dict.get('part_number', 1)
+        downloaded_at = row_dict.get('downloaded_at', '')
+
+        # Если такой части еще нет, или эта версия новее - сохраняем
+        if part_num not in parts_by_number:
+            parts_by_number[part_num] = row_dict
+        else:
+            # Сравниваем по времени (берем более свежую версию)
+            existing_time = parts_by_number[part_num].get('downloaded_at', '')
+            if downloaded_at > existing_time:
+                parts_by_number[part_num] = row_dict
+
+    # Преобразуем в список и сортируем по part_number
+    unique_parts = [parts_by_number[num] for num in sorted(parts_by_number.keys())]
+
+    # Определяем total_parts из первой части
+    total_parts = unique_parts[0].get('total_parts', 1) if unique_parts else 1
+
+    # Если все части на месте, возвращаем их
+    if len(unique_parts) == total_parts:
+        logging.info("Cache hit for %s: %d parts found (complete)", youtube_url, len(unique_parts))
+        return unique_parts
+
+    # Если есть хотя бы одна часть - возвращаем то что есть
+    # (даже если не все части сохранены - лучше отправить что есть чем скачивать заново)
+    if len(unique_parts) > 0:
+        logging.info("Cache hit for %s: %d parts found (expected %s, but using what we have)", youtube_url, len(unique_parts), total_parts)
+        return unique_parts
+
+    # Если ничего не найдено
+    logging.warning("No parts found for %s", youtube_url)
+    return None
+
+
 async def get_video_by_url(youtube_url: str) -> Optional[List[dict]]:
     """Получить информацию о видео по URL (возвращает все части самой свежей загрузки)"""
     async with aiosqlite.connect(DB_PATH) as db:
@@ -185,47 +242,35 @@ async def get_video_by_url(youtube_url: str) -> Optional[List[dict]]:
             (youtube_url,)
         ) as cursor:
             rows = await cursor.fetchall()
-            if not rows:
-                logging.debug(f"Cache miss for {youtube_url}: no records found")
-                return None
-            
-            # Собираем все уникальные части (берем самую свежую версию каждой части)
-            # Группируем по part_number и берем самую свежую запись для каждой части
-            parts_by_number = {}
-            for row in rows:
-                row_dict = dict(row)
-                part_num = row_dict.get('part_number', 1)
-                downloaded_at = row_dict.get('downloaded_at', '')
-                
-                # Если такой части еще нет, или эта версия новее - сохраняем
-                if part_num not in parts_by_number:
-                    parts_by_number[part_num] = row_dict
-                else:
-                    # Сравниваем по времени (берем более свежую версию)
-                    existing_time = parts_by_number[part_num].get('downloaded_at', '')
-                    if downloaded_at > existing_time:
-                        parts_by_number[part_num] = row_dict
-            
-            # Преобразуем в список и сортируем по part_number
-            unique_parts = [parts_by_number[num] for num in sorted(parts_by_number.keys())]
-            
-            # Определяем total_parts из первой части
-            total_parts = unique_parts[0].get('total_parts', 1) if unique_parts else 1
-            
-            # Если все части на месте, возвращаем их
-            if len(unique_parts) == total_parts:
-                logging.info(f"Cache hit for {youtube_url}: {len(unique_parts)} parts found (complete)")
-                return unique_parts
-            
-            # Если есть хотя бы одна часть - возвращаем то что есть
-            # (даже если не все части сохранены - лучше отправить что есть чем скачивать заново)
-            if len(unique_parts) > 0:
-                logging.info(f"Cache hit for {youtube_url}: {len(unique_parts)} parts found (expected {total_parts}, but using what we have)")
-                return unique_parts
-            
-            # Если ничего не найдено
-            logging.warning(f"No parts found for {youtube_url}")
-            return None
+            return _collect_parts(youtube_url, [dict(row) for row in rows])
+
+
+async def get_videos_by_urls(youtube_urls: List[str]) -> Dict[str, List[dict]]:
+    """Получить закэшированные видео для списка URL одним запросом (только найденные)"""
+    if not youtube_urls:
+        return {}
+    async with aiosqlite.connect(DB_PATH) as db:
+        db.row_factory = aiosqlite.Row
+        placeholders = ", ".join("?" for _ in youtube_urls)
+        async with db.execute(
+            f"""SELECT * FROM videos 
+                WHERE youtube_url IN ({placeholders}) 
+                ORDER BY downloaded_at DESC, part_number ASC""",
+            tuple(youtube_urls)
+        ) as cursor:
+            rows = await cursor.fetchall()
+
+    rows_by_url = {}
+    for row in rows:
+        row_dict = dict(row)
+        rows_by_url.setdefault(row_dict['youtube_url'], []).append(row_dict)
+
+    cached = {}
+    for youtube_url, url_rows in rows_by_url.items():
+        parts = _collect_parts(youtube_url, url_rows)
+        if parts:
+            cached[youtube_url] = parts
+    return cached
 
 
 async def save_video(
@@ -249,7 +294,7 @@ async def save_video(
         ) as cursor:
             existing_row = await cursor.fetchone()
             if existing_row:
-                logging.info(f"Video part {part_number} already in cache for {youtube_url}, skipping save")
+                logging.info("Video part %s already in cache for %s, skipping save", part_number, youtube_url)
                 return existing_row[0]
         
         # Если части нет в кэше - сохраняем
@@ -299,11 +344,11 @@ async def save_video(
                     )
             
             await db.commit()
-            logging.info(f"Saved video part {part_number}/{total_parts} to cache: {youtube_url}")
+            logging.info("Saved video part %s/%s to cache: %s", part_number, total_parts, youtube_url)
             return cursor.lastrowid
         except aiosqlite.IntegrityError as e:
             # Если запись уже существует (UNIQUE constraint), просто возвращаем существующий id
-            logging.warning(f"Video part {part_number} already exists in cache (IntegrityError): {e}")
+            logging.warning("Video part %s already exists in cache (IntegrityError): %s", part_number, e)
             # Получаем существующую запись
             async with db.execute(
                 """SELECT id FROM videos 
@@ -317,6 +362,85 @@ async def save_video(
             return 0
 
 
+async def replace_video(
+    youtube_url: str,
+    user_id: int,
+    parts: List[Tuple[str, int]],
+    title: str = None,
+    performer: str = None
+):
+    """Заменить кэш видео свежезагруженными частями [(file_id, file_size), ...] без учёта в статистике.
+    Существующие части остаются за тем, кто их скачал; user_id получают только новые части"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        total_parts = len(parts)
+        for i, (file_id, file_size) in enumerate(parts, 1):
+            cursor = await db.execute(
+                """UPDATE videos 
+                   SET file_id = ?, file_size = ?, total_parts = ?, downloaded_at = CURRENT_TIMESTAMP 
+                   WHERE youtube_url = ? AND part_number = ?""",
+                (file_id, file_size, total_parts, youtube_url, i)
+            )
+            if not cursor.rowcount:
+                await db.execute(
+                    """INSERT INTO videos 
+                       (youtube_url, user_id, file_id, file_size, title, performer, part_number, total_parts) 
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (youtube_url, user_id, file_id, file_size, title, performer, i, total_parts)
+                )
+        # Файл мог стать короче - лишние части старой нарезки больше не нужны
+        await db.execute(
+            "DELETE FROM videos WHERE youtube_url = ? AND part_number > ?",
+            (youtube_url, total_parts)
+        )
+        await db.commit()
+        logging.info("Refreshed cache for %s: %d parts", youtube_url, len(parts))
+
+
+async def record_video_requests(youtube_urls: List[str]):
+    """Учесть запросы ссылок в истории запросов"""
+    if not youtube_urls:
+        return
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.executemany(
+            "INSERT INTO video_requests (youtube_url) VALUES (?)",
+            [(url,) for url in youtube_urls]
+        )
+        await db.commit()
+
+
+async def get_prefetch_candidates(
+    window_days: int,
+    min_requests: int,
+    refresh_age_days: int,
+    limit: int
+) -> List[str]:
+    """Популярные за window_days ссылки, которых нет в кэше или кэш старше refresh_age_days"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute(
+            """SELECT r.youtube_url, COUNT(*) AS hits FROM video_requests r
+               WHERE r.requested_at >= datetime('now', ?)
+               GROUP BY r.youtube_url
+               HAVING hits >= ? AND COALESCE(
+                   (SELECT MAX(v.downloaded_at) FROM videos v WHERE v.youtube_url = r.youtube_url), ''
+               ) < datetime('now', ?)
+               ORDER BY hits DESC
+               LIMIT ?""",
+            (f"-{window_days} days", min_requests, f"-{refresh_age_days} days", limit)
+        ) as cursor:
+            rows = await cursor.fetchall()
+            return [row[0] for row in rows]
+
+
+async def prune_video_requests(max_age_days: int):
+    """Удалить историю запросов старше max_age_days"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            "DELETE FROM video_requests WHERE requested_at < datetime('now', ?)",
+            (f"-{max_age_days} days",)
+        )
+        await db.commit()
+
+
 async def increment_user_requests(user_id: int):
     """Увеличить счетчик попыток скачивания пользователя (используется при отправке из кэша)"""
     async with aiosqlite.connect(DB_PATH) as db:
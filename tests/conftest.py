@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Модули бота читают окружение при импорте - задаём его до импорта в тестах
+_TMP_DIR = tempfile.mkdtemp(prefix="ubot-tests-")
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("DATA_DIR", os.path.join(_TMP_DIR, "data"))
+os.environ.setdefault("DOWNLOAD_DIR", os.path.join(_TMP_DIR, "downloads"))
+os.environ.setdefault("LOG_FILE", os.path.join(_TMP_DIR, "bot.log"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,70 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import admission
+import bot
+import tools
+from admission import AdmissionController, estimate_job_bytes
+
+
+def test_adjust_corrects_reservation(tmp_path):
+    controller = AdmissionController(str(tmp_path))
+    estimated = estimate_job_bytes()
+    assert controller.try_admit(7, estimated) is None
+
+    real = estimate_job_bytes(3 * 3600)
+    controller.adjust(7, estimated, real)
+    assert controller.bytes == real
+    assert controller.user_bytes[7] == real
+
+    controller.release(7, real)
+    assert controller.bytes == 0
+    assert not controller.user_bytes
+
+
+def test_disk_fits_counts_reserved_bytes(tmp_path, monkeypatch):
+    controller = AdmissionController(str(tmp_path))
+    monkeypatch.setattr(controller, "free_disk", lambda: admission.MIN_FREE_DISK + 1000)
+    assert controller.disk_fits(1000)
+    assert controller.try_admit(7, 600) is None
+    assert not controller.disk_fits(1000)
+
+
+def test_progress_hook_reports_duration_once():
+    durations = []
+    job = {'progress': None, 'text': None, 'cancel': None, 'duration': durations.append}
+    d = {'status': 'downloading', 'downloaded_bytes': 0, 'info_dict': {'duration': 5400}}
+    tools._progress_hook(job, d)
+    tools._progress_hook(job, d)
+    assert durations == [5400]
+
+
+def test_worker_corrects_reservation_from_download_thread(monkeypatch):
+    seen = []
+
+    async def fake_process(msg, url, batch, on_duration=None):
+        # Колбэк вызывается из потока скачивания, как в get_audio
+        thread = threading.Thread(target=on_duration, args=(3 * 3600,))
+        thread.start()
+        thread.join()
+        await asyncio.sleep(0)
+        seen.append((bot.admission.bytes, bot.admission.user_bytes.get(7)))
+        return True
+
+    async def run():
+        monkeypatch.setattr(bot, "download_queue", asyncio.Queue())
+        monkeypatch.setattr(bot, "process_audio_download", fake_process)
+        estimated = estimate_job_bytes()
+        assert bot.admission.try_admit(7, estimated) is None
+        message = SimpleNamespace(from_user=SimpleNamespace(id=7))
+        bot.download_queue.put_nowait((message, "https://youtu.be/x", None, estimated))
+        task = asyncio.create_task(bot.worker())
+        await bot.download_queue.join()
+        task.cancel()
+
+    asyncio.run(run())
+    real = estimate_job_bytes(3 * 3600)
+    assert seen == [(real, real)]
+    assert bot.admission.bytes == 0
+    assert bot.admission.jobs == 0
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+from aiogram.types import FSInputFile
+
+import bot
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_upload_file_is_uri_for_local_bot_api(monkeypatch, tmp_path):
+    path = tmp_path / "input.mp3"
+    monkeypatch.setattr(bot, "BOT_API_LOCAL", True)
+    assert bot.get_upload_file(str(path)) == path.as_uri()
+
+
+def test_upload_file_is_uploaded_for_cloud_bot_api(monkeypatch, tmp_path):
+    path = tmp_path / "input.mp3"
+    monkeypatch.setattr(bot, "BOT_API_LOCAL", False)
+    upload = bot.get_upload_file(str(path))
+    assert isinstance(upload, FSInputFile)
+    assert Path(upload.path) == path
+
+
+def import_bot(**env):
+    """Импорт bot.py в отдельном процессе с заданным окружением: проверки идут при импорте"""
+    env = {key: value for key, value in dict(os.environ, **env).items() if value is not None}
+    return subprocess.run(
+        [sys.executable, "-c", "import bot"], cwd=ROOT, env=env, capture_output=True, text=True
+    )
+
+
+@pytest.mark.parametrize("size, api_url, error", [
+    (str(51*1024*1024), None, "только вместе с BOT_API_URL"),
+    (str(2001*1024*1024), "http://localhost:8081", "не может быть больше 2000 МБ"),
+])
+def test_upload_size_validated_at_startup(size, api_url, error):
+    result = import_bot(MAX_UPLOAD_SIZE=size, BOT_API_URL=api_url)
+    assert result.returncode != 0
+    assert error in result.stderr
+
+
+def test_large_upload_size_allowed_with_own_bot_api():
+    result = import_bot(MAX_UPLOAD_SIZE=str(2000*1024*1024), BOT_API_URL="http://localhost:8081")
+    assert result.returncode == 0, result.stderr
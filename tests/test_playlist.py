@@ -0,0 +1,193 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import yt_dlp
+
+import admission
+import bot
+import database
+import tools
+
+
+@pytest.mark.parametrize("link", [
+    "https://www.youtube.com/playlist?list=PL123",
+    "https://www.youtube.com/watch?list=PL123",
+    "https://www.youtube.com/@chan",
+    "https://www.youtube.com/@chan/",
+    "https://www.youtube.com/@chan/featured",
+    "https://www.youtube.com/@chan/videos",
+    "https://www.youtube.com/@chan/streams",
+    "https://www.youtube.com/@chan/shorts",
+    "https://www.youtube.com/channel/UC123/videos",
+    "https://www.youtube.com/c/name",
+    "https://www.youtube.com/user/name/videos",
+])
+def test_playlist_urls(link):
+    assert tools.is_playlist_url(link)
+
+
+@pytest.mark.parametrize("link", [
+    "https://www.youtube.com/watch?v=abc",
+    "https://www.youtube.com/watch?v=abc&list=PL123",
+    "https://youtu.be/abc?list=PL123",
+    "https://www.youtube.com/playlist",
+    "https://www.youtube.com/shorts/abc",
+    "https://www.youtube.com/@chan/videos/extra",
+])
+def test_video_urls(link):
+    assert not tools.is_playlist_url(link)
+
+
+class FakeYoutubeDL:
+    """YoutubeDL для плоского извлечения: запоминает ссылку и параметры"""
+    calls = []
+    entries = []
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def extract_info(self, link, download):
+        self.calls.append((link, self.opts))
+        return {'title': "Плейлист", 'entries': self.entries}
+
+
+@pytest.fixture
+def fake_ydl(monkeypatch):
+    monkeypatch.setattr(yt_dlp, "YoutubeDL", FakeYoutubeDL)
+    monkeypatch.setattr(FakeYoutubeDL, "calls", [])
+    return FakeYoutubeDL
+
+
+def test_playlist_entries_filter_and_order(fake_ydl, monkeypatch):
+    monkeypatch.setattr(fake_ydl, "entries", [
+        {'id': "b", 'ie_key': "Youtube", 'duration': 60},
+        None,
+        {'id': "a", 'duration': None},
+        {'id': "list", 'ie_key': "YoutubeTab"},  # Вложенный плейлист
+        {'ie_key': "Youtube"},                  # Без id
+        {'id': "b", 'ie_key': "Youtube", 'duration': 90},  # Повтор
+        {'id': "c", 'ie_key': "Youtube", 'duration': 30},
+    ])
+
+    title, entries = tools.get_playlist_entries("https://www.youtube.com/playlist?list=PL123")
+
+    assert title == "Плейлист"
+    assert list(entries.items()) == [
+        ("https://www.youtube.com/watch?v=b", 60),
+        ("https://www.youtube.com/watch?v=a", None),
+        ("https://www.youtube.com/watch?v=c", 30),
+    ]
+    link, opts = fake_ydl.calls[0]
+    assert link == "https://www.youtube.com/playlist?list=PL123"
+    assert opts['extract_flat'] == 'in_playlist'
+    assert opts['playlistend'] == tools.PLAYLIST_MAX_ITEMS
+
+
+@pytest.mark.parametrize("link", ["https://www.youtube.com/@chan", "https://www.youtube.com/@chan/featured/"])
+def test_channel_home_expands_to_videos_tab(fake_ydl, monkeypatch, link):
+    monkeypatch.setattr(fake_ydl, "entries", [])
+    tools.get_playlist_entries(link)
+    assert fake_ydl.calls[0][0] == "https://www.youtube.com/@chan/videos"
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "bot.db"))
+    asyncio.run(database.init_db())
+    return asyncio.run(database.create_user(7, "user", "user"))
+
+
+def save(user_id, url, file_id, part_number=1, total_parts=1):
+    return asyncio.run(database.save_video(
+        youtube_url=url, user_id=user_id, file_id=file_id, file_size=3,
+        title="title", performer="performer", part_number=part_number, total_parts=total_parts
+    ))
+
+
+def test_get_videos_by_urls_returns_only_cached(db):
+    save(db, "https://youtu.be/one", "one")
+    save(db, "https://youtu.be/parts", "part2", part_number=2, total_parts=2)
+    save(db, "https://youtu.be/parts", "part1", part_number=1, total_parts=2)
+
+    cached = asyncio.run(database.get_videos_by_urls(
+        ["https://youtu.be/one", "https://youtu.be/parts", "https://youtu.be/missing"]
+    ))
+
+    assert set(cached) == {"https://youtu.be/one", "https://youtu.be/parts"}
+    assert [p['file_id'] for p in cached["https://youtu.be/one"]] == ["one"]
+    assert [p['file_id'] for p in cached["https://youtu.be/parts"]] == ["part1", "part2"]
+    assert asyncio.run(database.get_videos_by_urls([])) == {}
+
+
+def test_collect_parts_keeps_newest_version_of_each_part():
+    rows = [
+        {'part_number': 2, 'total_parts': 2, 'file_id': "old2", 'downloaded_at': "2024-01-01"},
+        {'part_number': 1, 'total_parts': 2, 'file_id': "new1", 'downloaded_at': "2024-02-01"},
+        {'part_number': 2, 'total_parts': 2, 'file_id': "new2", 'downloaded_at': "2024-02-01"},
+        {'part_number': 1, 'total_parts': 2, 'file_id': "old1", 'downloaded_at': "2024-01-01"},
+    ]
+    assert [p['file_id'] for p in database._collect_parts("url", rows)] == ["new1", "new2"]
+    assert database._collect_parts("url", []) is None
+
+
+class FakeStatus:
+    def __init__(self):
+        self.chat = SimpleNamespace(id=7)
+        self.edits = []
+
+    async def edit_text(self, text):
+        self.edits.append(text)
+
+
+def test_handle_playlist_sends_cached_and_queues_misses(db, monkeypatch, tmp_path):
+    urls = {f"https://www.youtube.com/watch?v={i}": 60 for i in "abcd"}
+    save(db, "https://www.youtube.com/watch?v=b", "cached-b")
+    sent = []
+    status = FakeStatus()
+
+    async def fake_send_audio(chat_id, audio, **kwargs):
+        sent.append(audio)
+
+    async def answer(text):
+        return status
+
+    monkeypatch.setattr(bot, "get_playlist_entries", lambda link: ("Плейлист", urls))
+    monkeypatch.setattr(bot.bot, "send_audio", fake_send_audio)
+    monkeypatch.setattr(bot, "CACHE_CHAT_ID", None)
+    monkeypatch.setattr(bot, "status_edit_times", {})
+    monkeypatch.setattr(bot, "PROGRESS_EDIT_INTERVAL", 0)
+    monkeypatch.setattr(bot, "admission", admission.AdmissionController(str(tmp_path)))
+    # Второй промах уже не помещается в лимит пользователя
+    monkeypatch.setattr(admission, "USER_MAX_QUEUED_JOBS", 2)
+    message = SimpleNamespace(
+        from_user=SimpleNamespace(id=7, full_name="user", username="user"),
+        chat=SimpleNamespace(id=7),
+        answer=answer,
+    )
+
+    async def run():
+        monkeypatch.setattr(bot, "download_queue", asyncio.Queue())
+        await bot.handle_playlist(message, "https://www.youtube.com/playlist?list=PL123")
+        queued = []
+        while not bot.download_queue.empty():
+            queued.append(bot.download_queue.get_nowait())
+        return queued
+
+    queued = asyncio.run(run())
+
+    assert sent == ["cached-b"]
+    assert [url for _, url, _, _ in queued] == [
+        "https://www.youtube.com/watch?v=a", "https://www.youtube.com/watch?v=c"
+    ]
+    batch = queued[0][2]
+    assert (batch.total, batch.cached, batch.rejected) == (4, 1, 1)
+    assert batch.reject_reason == "слишком много ваших ссылок уже в очереди"
+    assert queued[0][3] == admission.estimate_job_bytes(60)
+    assert "Не принято в очередь: 1" in status.edits[-1]
@@ -0,0 +1,158 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+import database
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "bot.db"))
+    asyncio.run(database.init_db())
+
+
+def run_prefetcher_once(monkeypatch):
+    """Один цикл prefetcher: выходим из него на запросе кандидатов"""
+    monkeypatch.setattr(bot, "PREFETCH_INTERVAL", 0)
+
+    async def stop(*args, **kwargs):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(database, "get_prefetch_candidates", stop)
+
+    async def run():
+        with pytest.raises(asyncio.CancelledError):
+            await bot.prefetcher()
+
+    asyncio.run(run())
+
+
+def test_prefetcher_keeps_admin_profile(db, monkeypatch):
+    asyncio.run(database.create_user(bot.ADMIN_ID, "Admin Name", "admin"))
+    run_prefetcher_once(monkeypatch)
+    admin = asyncio.run(database.get_user_by_telegram_id(bot.ADMIN_ID))
+    assert (admin['full_name'], admin['username']) == ("Admin Name", "admin")
+
+
+def test_prefetcher_creates_missing_admin(db, monkeypatch):
+    run_prefetcher_once(monkeypatch)
+    assert asyncio.run(database.get_user_by_telegram_id(bot.ADMIN_ID)) is not None
+
+
+def count_requests():
+    async def run():
+        async with database.aiosqlite.connect(database.DB_PATH) as conn:
+            async with conn.execute("SELECT COUNT(*) FROM video_requests") as cursor:
+                return (await cursor.fetchone())[0]
+
+    return asyncio.run(run())
+
+
+def test_requests_not_recorded_without_prefetch(db, monkeypatch):
+    monkeypatch.setattr(bot, "CACHE_CHAT_ID", None)
+    asyncio.run(bot.record_requests(["https://youtu.be/a"]))
+    assert count_requests() == 0
+
+    monkeypatch.setattr(bot, "CACHE_CHAT_ID", -100)
+    asyncio.run(bot.record_requests(["https://youtu.be/a"]))
+    assert count_requests() == 1
+
+
+def test_prefetcher_prunes_while_queue_busy(db, monkeypatch):
+    pruned = []
+
+    async def prune(max_age_days):
+        pruned.append(max_age_days)
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(bot, "PREFETCH_INTERVAL", 0)
+    monkeypatch.setattr(bot, "queue_idle", lambda: False)
+    monkeypatch.setattr(database, "prune_video_requests", prune)
+
+    async def run():
+        with pytest.raises(asyncio.CancelledError):
+            await bot.prefetcher()
+
+    asyncio.run(run())
+    assert pruned == [bot.PREFETCH_WINDOW_DAYS]
+
+
+@pytest.fixture
+def fake_prefetch(db, monkeypatch):
+    """prefetch_video с подменённым скачиванием и загрузкой в служебный чат"""
+    url = "https://youtu.be/prefetch"
+    uploads = []
+    saved = []
+
+    async def fake_download(link, job_dir, progress, cancel, on_duration):
+        path = os.path.join(job_dir, "input.mp3")
+        with open(path, "wb") as f:
+            f.write(b"mp3")
+        return [path], "title", "performer"
+
+    async def fake_send_audio(chat_id, audio, **kwargs):
+        # Загрузка не должна держать блокировку ссылки
+        uploads.append((url in bot.url_locks, os.path.exists(audio.path)))
+        return SimpleNamespace(audio=SimpleNamespace(file_id="file", file_size=3))
+
+    async def fake_replace_video(youtube_url, user_id, parts, **kwargs):
+        saved.append((youtube_url, parts))
+
+    monkeypatch.setattr(bot, "CACHE_CHAT_ID", -100)
+    monkeypatch.setattr(bot, "BOT_API_LOCAL", False)
+    monkeypatch.setattr(bot, "run_download", fake_download)
+    monkeypatch.setattr(bot.bot, "send_audio", fake_send_audio)
+    monkeypatch.setattr(database, "replace_video", fake_replace_video)
+    return url, uploads, saved
+
+
+def test_prefetch_uploads_outside_url_lock(fake_prefetch):
+    url, uploads, saved = fake_prefetch
+    assert asyncio.run(bot.prefetch_video(url, 1))
+    assert uploads == [(False, True)]
+    assert saved == [(url, [("file", 3)])]
+    job_dir = bot.get_job_dir(url)
+    assert not os.listdir(job_dir)
+    assert not os.path.exists(f"{job_dir}.upload")
+
+
+def test_prefetch_stops_before_upload_when_jobs_appear(fake_prefetch, monkeypatch):
+    url, uploads, saved = fake_prefetch
+    monkeypatch.setattr(bot, "queue_idle", lambda: False)
+    assert not asyncio.run(bot.prefetch_video(url, 1))
+    assert not uploads
+    assert not saved
+    assert not os.path.exists(f"{bot.get_job_dir(url)}.upload")
+
+
+def test_replace_video_keeps_owner(db):
+    url = "https://youtu.be/owned"
+
+    async def run():
+        owner = await database.create_user(7, "user", "user")
+        admin = await database.create_user(bot.ADMIN_ID)
+        for part in (1, 2):
+            await database.save_video(
+                youtube_url=url, user_id=owner, file_id=f"old{part}", file_size=3,
+                title="title", performer="performer", part_number=part, total_parts=2
+            )
+        await database.replace_video(url, admin, [("new1", 5)], title="title", performer="performer")
+        shrunk = await database.get_video_by_url(url)
+        history = await database.get_user_videos(7)
+
+        await database.replace_video(url, admin, [("new1", 5), ("new2", 5)], title="title")
+        grown = await database.get_video_by_url(url)
+        return owner, admin, shrunk, history, grown
+
+    owner, admin, shrunk, history, grown = asyncio.run(run())
+
+    assert [(p['file_id'], p['file_size'], p['total_parts'], p['user_id']) for p in shrunk] == [
+        ("new1", 5, 1, owner)
+    ]
+    assert [p['youtube_url'] for p in history] == [url]
+    assert [(p['file_id'], p['total_parts'], p['user_id']) for p in grown] == [
+        ("new1", 2, owner), ("new2", 2, admin)
+    ]
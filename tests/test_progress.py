@@ -0,0 +1,61 @@
+import asyncio
+
+import bot
+
+
+class FakeStatus:
+    def __init__(self, chat_id):
+        self.chat = type("Chat", (), {"id": chat_id})()
+        self.edits = []
+
+    async def edit_text(self, text):
+        self.edits.append(text)
+
+
+def test_edit_status_throttles_per_chat(monkeypatch):
+    monkeypatch.setattr(bot, "PROGRESS_EDIT_INTERVAL", 60)
+    monkeypatch.setattr(bot, "status_edit_times", {})
+    first, second = FakeStatus(1), FakeStatus(2)
+
+    async def run():
+        assert await bot.edit_status(first, "a")
+        assert not await bot.edit_status(first, "b")
+        assert await bot.edit_status(second, "a")
+        assert await bot.edit_status(first, "c", force=True)
+
+    asyncio.run(run())
+    assert first.edits == ["a", "c"]
+    assert second.edits == ["a"]
+
+
+def test_edit_status_forgets_idle_chats(monkeypatch):
+    monkeypatch.setattr(bot, "PROGRESS_EDIT_INTERVAL", 0)
+    monkeypatch.setattr(bot, "status_edit_times", {})
+
+    async def run():
+        for chat_id in range(100):
+            await bot.edit_status(FakeStatus(chat_id), "text")
+
+    asyncio.run(run())
+    assert len(bot.status_edit_times) == 1
+
+
+def test_download_progress_coalesces_thread_updates(monkeypatch):
+    monkeypatch.setattr(bot, "PROGRESS_EDIT_INTERVAL", 0.05)
+    monkeypatch.setattr(bot, "status_edit_times", {})
+    status = FakeStatus(1)
+
+    def download(progress):
+        for i in range(2000):
+            progress(f"{i // 20}%")
+
+    async def run():
+        progress = bot.DownloadProgress(status)
+        task = asyncio.create_task(progress.run())
+        await asyncio.to_thread(download, progress)
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(run())
+    assert 1 <= len(status.edits) <= 10
+    assert status.edits[-1] == "99%"
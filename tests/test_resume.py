@@ -0,0 +1,155 @@
+import http.server
+import re
+import threading
+
+import pytest
+
+import tools
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz: заголовок кадра и длина кадра в байтах
+MP3_FRAME = b"\xff\xfb\x90\x00" + b"\x00" * 413
+MP3_DATA = MP3_FRAME * 25000  # ~10 МБ, меньше MAX_SIZE - без нарезки
+DROP_AFTER = 3 * 1024 * 1024
+PAGE_HTML = "<html><body><audio src=\"/one.mp3\"></audio><audio src=\"/two.ogg\"></audio></body></html>"
+
+
+class DroppingServer(http.server.ThreadingHTTPServer):
+    """HTTP-сервер с поддержкой Range, обрывающий первую загрузку файла на DROP_AFTER байтах"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), DroppingHandler)
+        self.ranges = []
+        self.paths = []
+        self.dropped = 0
+
+
+class DroppingHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.endswith(".html"):
+            # Страница с несколькими видео, как вкладка канала
+            page = PAGE_HTML.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+            return
+        self.server.paths.append(self.path)
+        start, end = 0, len(MP3_DATA) - 1
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+        self.server.ranges.append(start)
+
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "audio/mpeg")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(MP3_DATA)}")
+        self.end_headers()
+
+        body = MP3_DATA[start:end + 1]
+        # Первый запрос делает экстрактор, второй - загрузка: её и обрываем
+        if len(self.server.ranges) == 2 and len(body) > DROP_AFTER:
+            self.server.dropped += 1
+            self.wfile.write(body[:DROP_AFTER])
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    srv = DroppingServer()
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+
+@pytest.fixture
+def ydl_opts(monkeypatch):
+    # ffmpeg в тестах не нужен: отдаём сразу MP3, конвертация не требуется
+    monkeypatch.setitem(tools.YDL_OPTS, 'postprocessors', [])
+    monkeypatch.setitem(tools.YDL_OPTS, 'format', 'best')
+    monkeypatch.setitem(tools.YDL_OPTS, 'cachedir', False)
+    monkeypatch.setitem(tools.YDL_OPTS, 'quiet', True)
+    monkeypatch.setitem(tools.YDL_OPTS, 'noprogress', True)
+    tools._reset_ydl()
+    yield
+    tools._reset_ydl()
+
+
+def test_retry_resumes_part_file(server, ydl_opts, monkeypatch, tmp_path):
+    # Без внутренних повторов yt-dlp обрыв проваливает попытку, и докачивает уже цикл get_audio
+    monkeypatch.setitem(tools.YDL_OPTS, 'retries', 0)
+    monkeypatch.setitem(tools.YDL_OPTS, 'http_chunk_size', None)
+
+    files, _, _ = tools.get_audio(f"http://127.0.0.1:{server.server_port}/audio.mp3", str(tmp_path))
+
+    assert server.dropped == 1
+    assert server.ranges[-1] == DROP_AFTER
+    assert files == [str(tmp_path / "input.mp3")]
+    assert (tmp_path / "input.mp3").read_bytes() == MP3_DATA
+
+
+def test_chunked_download_uses_ranges(server, ydl_opts, monkeypatch, tmp_path):
+    monkeypatch.setitem(tools.YDL_OPTS, 'http_chunk_size', 1024 * 1024)
+
+    files, _, _ = tools.get_audio(f"http://127.0.0.1:{server.server_port}/audio.mp3", str(tmp_path))
+
+    # Файл ~10 МБ качается Range-запросами по 1 МБ
+    assert server.dropped == 0
+    assert len(server.ranges) > 10
+    assert (tmp_path / "input.mp3").read_bytes() == MP3_DATA
+    assert files
+
+
+
+def test_cancel_keeps_part_file(server, ydl_opts, monkeypatch, tmp_path):
+    monkeypatch.setitem(tools.YDL_OPTS, 'http_chunk_size', 1024 * 1024)
+
+    with pytest.raises(tools.DownloadCancelled):
+        tools.get_audio(
+            f"http://127.0.0.1:{server.server_port}/audio.mp3", str(tmp_path), cancel=lambda: True
+        )
+
+    assert [p.name for p in tmp_path.iterdir()] == ["input.mp3.part"]
+
+
+def test_cancel_before_conversion(server, ydl_opts, monkeypatch, tmp_path):
+    # Конвертация не начнётся: отмена срабатывает в хуке постпроцессора, ffmpeg не нужен
+    monkeypatch.setitem(tools.YDL_OPTS, 'postprocessors', [{
+        'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '128',
+    }])
+    # Без повторов: отмену должен поймать именно хук постпроцессора, а не следующая попытка
+    monkeypatch.setattr(tools, 'DOWNLOAD_ATTEMPTS', 1)
+    tools._reset_ydl()
+    downloaded = tmp_path / "input.mp3"
+    # Отмена запрашивается уже после завершения скачивания (после последнего progress-хука)
+    stages = []
+
+    with pytest.raises(tools.DownloadCancelled):
+        tools.get_audio(
+            f"http://127.0.0.1:{server.server_port}/audio.mp3", str(tmp_path),
+            progress=stages.append, cancel=lambda: "Аудио скачано, обрабатываю..." in stages
+        )
+
+    assert downloaded.read_bytes() == MP3_DATA
+
+
+def test_multi_entry_page_downloads_one_item(server, ydl_opts, tmp_path):
+    tools.get_audio(f"http://127.0.0.1:{server.server_port}/tab.html", str(tmp_path))
+
+    assert set(server.paths) == {"/one.mp3"}
+    assert [p.name for p in tmp_path.iterdir()] == ["input.mp3"]
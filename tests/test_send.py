@@ -0,0 +1,59 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+
+import bot
+import database
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "bot.db"))
+    asyncio.run(database.init_db())
+
+
+@pytest.fixture
+def flood_once(monkeypatch):
+    """send_audio, который первый раз отвечает 429, а затем принимает файл"""
+    calls = []
+
+    async def fake_send_audio(chat_id, audio, **kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise TelegramRetryAfter(method=None, message="Too Many Requests", retry_after=0)
+        return SimpleNamespace(audio=SimpleNamespace(file_id=f"file{len(calls)}", file_size=3))
+
+    monkeypatch.setattr(bot.bot, "send_audio", fake_send_audio)
+    return calls
+
+
+def test_send_audio_with_retry_waits_on_flood_control(flood_once):
+    sent = asyncio.run(bot.send_audio_with_retry(7, "file", request_timeout=5))
+    assert sent.audio.file_id == "file2"
+    assert [kwargs["request_timeout"] for kwargs in flood_once] == [5, 5]
+
+
+def test_downloaded_item_survives_flood_control(db, flood_once, monkeypatch):
+    url = "https://youtu.be/flood"
+
+    async def fake_download(link, job_dir, progress, cancel, on_duration):
+        path = os.path.join(job_dir, "input.mp3")
+        with open(path, "wb") as f:
+            f.write(b"mp3")
+        return [path], "title", "performer"
+
+    monkeypatch.setattr(bot, "BOT_API_LOCAL", False)
+    monkeypatch.setattr(bot, "run_download", fake_download)
+    message = SimpleNamespace(
+        from_user=SimpleNamespace(id=7, full_name="user", username="user"),
+        chat=SimpleNamespace(id=7),
+    )
+    batch = SimpleNamespace()  # В пакетном режиме статус-сообщения нет
+
+    assert asyncio.run(bot._process_audio_download(message, url, batch))
+    assert [kwargs["request_timeout"] for kwargs in flood_once] == [bot.UPLOAD_TIMEOUT] * 2
+    parts = asyncio.run(database.get_video_by_url(url))
+    assert [part["file_id"] for part in parts] == ["file2"]
@@ -0,0 +1,132 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import bot
+
+SECRET = "test-secret"
+
+
+async def start_app(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def make_fake_bot_api(calls):
+    """Заглушка Bot API: записывает вызовы методов и отвечает успехом"""
+    async def handle(request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        calls.append((method, data))
+        result = True
+        if method == "sendMessage":
+            result = {
+                "message_id": len(calls), "date": 0,
+                "chat": {"id": int(data["chat_id"]), "type": "private"},
+                "text": data["text"],
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+def replies(calls):
+    return [data for method, data in calls if method == "sendMessage"]
+
+
+def make_update(update_id, text="/ping"):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": 7, "type": "private"},
+            "from": {"id": 7, "is_bot": False, "first_name": "user"},
+        },
+    }
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", SECRET)
+    calls = []
+
+    async def run(scenario, expected_replies=0):
+        api_runner, api_url = await start_app(make_fake_bot_api(calls))
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api_url))
+        monkeypatch.setattr(bot.bot, "session", session)
+        hook_runner, hook_url = await start_app(bot.create_webhook_app())
+        try:
+            async with aiohttp.ClientSession() as client:
+                await scenario(client, hook_url + bot.WEBHOOK_PATH)
+            # Обновления обрабатываются в фоне уже после ответа 200
+            for _ in range(100):
+                await asyncio.sleep(0.05)
+                if len(replies(calls)) >= expected_replies:
+                    break
+        finally:
+            await hook_runner.cleanup()
+            await session.close()
+            await api_runner.cleanup()
+
+    return calls, run
+
+
+def test_webhook_rejects_wrong_secret(fake_api):
+    calls, run = fake_api
+    statuses = []
+
+    async def scenario(client, url):
+        async with client.post(url, json=make_update(1)) as response:
+            statuses.append(response.status)
+        headers = {"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+        async with client.post(url, json=make_update(2), headers=headers) as response:
+            statuses.append(response.status)
+
+    asyncio.run(run(scenario))
+    assert statuses == [401, 401]
+    assert not replies(calls)
+
+
+def test_webhook_handles_concurrent_updates(fake_api):
+    calls, run = fake_api
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+    statuses = []
+
+    async def scenario(client, url):
+        async def post(update_id):
+            async with client.post(url, json=make_update(update_id), headers=headers) as response:
+                statuses.append(response.status)
+        await asyncio.gather(*(post(i) for i in range(20)))
+
+    asyncio.run(run(scenario, expected_replies=20))
+    assert statuses == [200] * 20
+    assert [reply["text"] for reply in replies(calls)] == ["Pong! Бот работает."] * 20
+
+
+def test_concurrency_limit_middleware_bounds_handlers():
+    middleware = bot.ConcurrencyLimitMiddleware(3)
+    running = 0
+    peak = 0
+
+    async def handler(event, data):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        await asyncio.gather(*(middleware(handler, None, {}) for _ in range(20)))
+
+    asyncio.run(run())
+    assert peak == 3
@@ -1,36 +1,275 @@
-from yt_dlp import YoutubeDL
-from mutagen.mp3 import MP3
+from urllib.parse import urlparse, parse_qs
+from functools import partial
+import hashlib
 import os
+import re
+import shutil
+import threading
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
-MAX_SIZE = 48*1024*1024        # Максимальный размер аудиофайла в Telegram в байтах
+# yt_dlp и mutagen импортируются при первом скачивании: это сотни миллисекунд
+# и заметный объём памяти, которые не должны задерживать запуск бота
 
-def get_audio(link):
-    def downloader(link):
-        ydl_opts = {
-            'format': 'bestaudio[abr<=128]/bestaudio',  # выбрать аудио ≤64k, иначе лучшее
-            # 'outtmpl': '%(title)s.%(ext)s',
-            'outtmpl': 'input.%(ext)s',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '128',  # битрейт MP3
-            }],
-        }
+# Максимальный размер аудиофайла в Telegram в байтах: 50 МБ для облачного Bot API,
+# до 2000 МБ для своего telegram-bot-api - тогда большие файлы не режутся на части
+MAX_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", str(48*1024*1024)))
+DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")             # Рабочие директории задач
+PLAYLIST_MAX_ITEMS = int(os.getenv("PLAYLIST_MAX_ITEMS", "50"))  # Сколько видео брать из плейлиста/канала
+YDL_MAX_JOBS = int(os.getenv("YDL_MAX_JOBS", "50"))              # Через сколько задач пересоздавать YoutubeDL
+YDL_CACHE_DIR = os.path.join(os.getenv("DATA_DIR", "."), "yt-dlp-cache")  # Кэш yt-dlp (player JS и т.п.)
+CONCURRENT_FRAGMENTS = int(os.getenv("CONCURRENT_FRAGMENTS", "4"))          # Параллельные фрагменты DASH/HLS
+HTTP_CHUNK_SIZE = int(os.getenv("HTTP_CHUNK_SIZE", str(10*1024*1024)))      # Размер Range-запроса, 0 - без разбивки
+DOWNLOAD_ATTEMPTS = int(os.getenv("DOWNLOAD_ATTEMPTS", "3"))                # Попытки скачивания с докачкой .part
+JOB_DIR_TTL = int(os.getenv("JOB_DIR_TTL", str(24*3600)))                   # Время жизни брошенных директорий, сек
+
+YDL_OPTS = {
+    'format': 'bestaudio[abr<=128]/bestaudio',  # выбрать аудио ≤64k, иначе лучшее
+    # 'outtmpl': '%(title)s.%(ext)s',
+    'outtmpl': 'input.%(ext)s',  # относительно paths['home'] - рабочей директории задачи
+    'noplaylist': True,  # из ссылки вида watch?v=...&list=... качаем только само видео
+    # Страница с несколькими видео, не распознанная is_playlist_url (например, вкладка канала
+    # /playlists), иначе скачалась бы целиком в один input.%(ext)s
+    'playlist_items': '1',
+    'cachedir': YDL_CACHE_DIR,
+    'concurrent_fragment_downloads': CONCURRENT_FRAGMENTS,
+    'http_chunk_size': HTTP_CHUNK_SIZE or None,
+    'continuedl': True,  # докачка .part из рабочей директории задачи
+    'retries': 10,
+    'fragment_retries': 10,
+    'postprocessors': [{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'mp3',
+        'preferredquality': '128',  # битрейт MP3
+    }],
+}
+
+# Тёплый YoutubeDL на каждый поток-воркер: экстракторы, куки и кэш инициализируются один раз.
+# get_audio запускается в отдельном пуле из DOWNLOAD_WORKERS потоков (см. bot.py),
+# поэтому экземпляров столько же, сколько воркеров скачивания
+_ydl_local = threading.local()
+_ydl_instances = set()
+_ydl_instances_lock = threading.Lock()
+
+MB = 1024*1024
+
+class DownloadCancelled(Exception):
+    """Скачивание прервано по запросу (например, фоновая задача уступает пользовательской)"""
+
+
+CHANNEL_PATH_REGEX = re.compile(r"^/(?:@[^/]+|channel/[^/]+|c/[^/]+|user/[^/]+)(?:/(featured|videos|streams|shorts))?/?$")
+
+
+def is_playlist_url(link):
+    """Ссылка на плейлист или канал (а не на отдельное видео)"""
+    parsed = urlparse(link)
+    if "youtu.be" in parsed.netloc:
+        return False
+    query = parse_qs(parsed.query)
+    if parsed.path.rstrip("/") == "/playlist":
+        return "list" in query
+    if "list" in query and "v" not in query:
+        return True
+    return bool(CHANNEL_PATH_REGEX.match(parsed.path))
+
+
+def get_playlist_entries(link):
+    """Ссылки на видео плейлиста/канала с длительностями, без скачивания (плоское извлечение)"""
+    parsed = urlparse(link)
+    match = CHANNEL_PATH_REGEX.match(parsed.path)
+    if match and match.group(1) in (None, 'featured'):
+        # Главная страница канала содержит вкладки, а не видео
+        channel_path = parsed.path.rstrip('/').removesuffix('/featured')
+        link = f"{parsed.scheme}://{parsed.netloc}{channel_path}/videos"
+
+    from yt_dlp import YoutubeDL
+
+    ydl_opts = {
+        'extract_flat': 'in_playlist',
+        'skip_download': True,
+        'playlistend': PLAYLIST_MAX_ITEMS,
+        'quiet': True,
+    }
+    with YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(link, download=False)
+
+    # {url: длительность в секундах или None}, порядок плейлиста сохраняется
+    entries = {}
+    for entry in info.get('entries') or []:
+        if not entry or entry.get('ie_key') not in (None, 'Youtube') or not entry.get('id'):
+            continue
+        url = f"https://www.youtube.com/watch?v={entry['id']}"
+        entries.setdefault(url, entry.get('duration'))
+    logger.info("Плейлист %s: найдено %d видео", link, len(entries))
+    return info.get('title'), entries
+
+
+def _get_ydl():
+    """YoutubeDL текущего потока (пересоздаётся после YDL_MAX_JOBS задач)"""
+    ydl = getattr(_ydl_local, 'ydl', None)
+    if ydl is None or _ydl_local.jobs >= YDL_MAX_JOBS:
+        from yt_dlp import YoutubeDL
+
+        _reset_ydl()
+        # Хуки могут вызываться из потоков фрагментов, поэтому состояние задачи
+        # привязано к экземпляру, а не к threading.local
+        job = {'progress': None, 'text': None, 'cancel': None, 'duration': None}
+        ydl = YoutubeDL(dict(
+            YDL_OPTS,
+            progress_hooks=[partial(_progress_hook, job)],
+            postprocessor_hooks=[partial(_postprocessor_hook, job)],
+        ))
+        _ydl_local.ydl = ydl
+        _ydl_local.job = job
+        _ydl_local.jobs = 0
+        with _ydl_instances_lock:
+            _ydl_instances.add(ydl)
+    _ydl_local.jobs += 1
+    return ydl
+
+
+def _reset_ydl():
+    """Закрыть YoutubeDL текущего потока, следующая задача создаст новый"""
+    ydl = getattr(_ydl_local, 'ydl', None)
+    _ydl_local.ydl = None
+    if ydl is not None:
+        with _ydl_instances_lock:
+            _ydl_instances.discard(ydl)
+        _close_ydl(ydl)
+
+
+def _close_ydl(ydl):
+    try:
+        ydl.close()
+    except Exception as e:
+        logger.debug(f"Ошибка при закрытии YoutubeDL: {e}")
+
+
+def close_all_ydl():
+    """Закрыть экземпляры YoutubeDL всех потоков (при остановке бота)"""
+    with _ydl_instances_lock:
+        instances = list(_ydl_instances)
+        _ydl_instances.clear()
+    for ydl in instances:
+        _close_ydl(ydl)
 
+
+def _report_progress(job, text):
+    """Передать текст прогресса в колбэк текущей задачи (только при изменении)"""
+    callback = job['progress']
+    if callback is None or text == job['text']:
+        return
+    job['text'] = text
+    try:
+        callback(text)
+    except Exception as e:
+        logger.debug("Ошибка в колбэке прогресса: %s", e)
+
+
+def _progress_hook(job, d):
+    """progress_hooks yt-dlp: проценты скачивания и проверка отмены"""
+    if job['cancel'] is not None and job['cancel']():
+        # Исключение из хука прерывает скачивание, .part остаётся для докачки
+        raise DownloadCancelled()
+    if job['duration'] is not None:
+        # Длительность сообщаем один раз, с первым вызовом хука
+        callback, job['duration'] = job['duration'], None
+        seconds = (d.get('info_dict') or {}).get('duration')
+        if seconds:
+            try:
+                callback(seconds)
+            except Exception as e:
+                logger.debug("Ошибка в колбэке длительности: %s", e)
+    if d['status'] == 'downloading':
+        done = d.get('downloaded_bytes') or 0
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if total:
+            _report_progress(job, f"Скачиваю аудио... {min(done*100//total, 100)}% из {total/MB:.1f} МБ")
+        else:
+            _report_progress(job, f"Скачиваю аудио... {done/MB:.1f} МБ")
+    elif d['status'] == 'finished':
+        _report_progress(job, "Аудио скачано, обрабатываю...")
+
+
+def _postprocessor_hook(job, d):
+    """postprocessor_hooks yt-dlp: этап конвертации ffmpeg и проверка отмены перед ним"""
+    if d['status'] == 'started' and job['cancel'] is not None and job['cancel']():
+        # Скачанный исходник остаётся в job_dir, следующая попытка только сконвертирует его
+        raise DownloadCancelled()
+    if d['status'] == 'started' and d.get('postprocessor') == 'ExtractAudio':
+        _report_progress(job, "Конвертирую в MP3...")
+
+
+def preload():
+    """Импорт тяжёлых зависимостей заранее, чтобы первое скачивание их не ждало"""
+    import yt_dlp  # noqa: F401
+    import mutagen.mp3  # noqa: F401
+
+
+def get_job_dir(link):
+    """Рабочая директория задачи (одна и та же для одной ссылки)"""
+    job_id = hashlib.sha1(link.encode("utf-8")).hexdigest()[:16]
+    job_dir = os.path.join(DOWNLOAD_DIR, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    # Докачка в старую директорию продлевает её жизнь для cleanup_stale_job_dirs
+    os.utime(job_dir)
+    return job_dir
+
+
+def cleanup_job_dir(job_dir):
+    """Удаление рабочей директории задачи вместе с временными файлами"""
+    shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def cleanup_stale_job_dirs(max_age=JOB_DIR_TTL):
+    """Удаление директорий неудавшихся задач, которые давно не докачивались"""
+    if not os.path.isdir(DOWNLOAD_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(DOWNLOAD_DIR):
+        job_dir = os.path.join(DOWNLOAD_DIR, name)
         try:
-            with YoutubeDL(ydl_opts) as ydl:
+            if os.path.isdir(job_dir) and now - os.path.getmtime(job_dir) > max_age:
+                cleanup_job_dir(job_dir)
+                logger.info("Удалена устаревшая рабочая директория %s", job_dir)
+        except OSError as e:
+            logger.warning("Не удалось проверить %s: %s", job_dir, e)
+
+
+def get_audio(link, job_dir=".", progress=None, cancel=None, on_duration=None):
+    """Скачивание аудио в job_dir. progress(text) и cancel() вызываются из потока скачивания,
+    cancel() возвращает True, чтобы прервать скачивание (DownloadCancelled).
+    on_duration(seconds) вызывается из того же потока, когда стала известна длительность видео"""
+    def downloader(link):
+        # Повторная попытка продолжает .part-файл в той же job_dir, а не качает с нуля
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            ydl = _get_ydl()
+            ydl.params['paths'] = {'home': job_dir}
+            _ydl_local.job.update(progress=progress, text=None, cancel=cancel, duration=on_duration)
+
+            try:
                 info = ydl.extract_info(link, download=True)
                 title = info.get('title')
                 channel = info.get('uploader')
-            return "input.mp3", title, channel
-        except Exception as e:
-            logger.error(f"Ошибка при скачивании {link}: {e}")
-            return None, None, None
+                return os.path.join(job_dir, "input.mp3"), title, channel
+            except DownloadCancelled:
+                logger.info("Скачивание %s прервано", link)
+                _reset_ydl()
+                raise
+            except Exception as e:
+                logger.error("Ошибка при скачивании %s (попытка %d/%d): %s", link, attempt, DOWNLOAD_ATTEMPTS, e)
+                # После ошибки состояние экземпляра не гарантировано - пересоздаём
+                _reset_ydl()
+        return None, None, None
 
-    audio_file, title, channel = downloader(link)
+    try:
+        audio_file, title, channel = downloader(link)
+    finally:
+        job = getattr(_ydl_local, 'job', None)
+        if job is not None:
+            job.update(progress=None, cancel=None, duration=None)
     # print(f"Название видео: {title}")
     # print(f"Канал: {channel}")
 
@@ -39,10 +278,12 @@ def get_audio(link):
 
     SIZE = os.path.getsize(audio_file)
 
+    from mutagen.mp3 import MP3
+
     try:
         audio = MP3(audio_file)
     except Exception as e:
-        logger.error(f"Ошибка при чтении MP3 файла {audio_file}: {e}")
+        logger.error("Ошибка при чтении MP3 файла %s: %s", audio_file, e)
         return [], None, None
     # print(audio.info.length)
     # print(audio.info.bitrate)
@@ -52,10 +293,12 @@ def get_audio(link):
     # print("Длина изначальной дорожки:", audio.info.length)
 
     if SIZE <= MAX_SIZE:
-        logger.info(f"Файл поместится в одно сообщение. Размер: {SIZE} байт")
+        logger.info("Файл поместится в одно сообщение. Размер: %d байт", SIZE)
         return [audio_file], title, channel
     else:
-        logger.info(f"Необходимо уменьшить размер. Текущий размер: {SIZE} байт")
+        logger.info("Необходимо уменьшить размер. Текущий размер: %d байт", SIZE)
+        if progress:
+            progress("Файл большой, нарезаю на части...")
         chunk_files = []
         def cut_audio():
             try:
@@ -65,14 +308,14 @@ def get_audio(link):
                         chunk_data = f.read(MAX_SIZE)
                         if not chunk_data:
                             break
-                        chunk_name = f"chunk_{chunk_num}.mp3"
+                        chunk_name = os.path.join(job_dir, f"chunk_{chunk_num}.mp3")
                         with open(chunk_name, "wb") as chunk_file:
                             chunk_file.write(chunk_data)
-                        logger.info(f"Сохранён {chunk_name} ({len(chunk_data)} байт)")
+                        logger.info("Сохранён %s (%d байт)", chunk_name, len(chunk_data))
                         chunk_files.append(chunk_name)
                         chunk_num += 1
             except Exception as e:
-                logger.error(f"Ошибка при нарезке файла: {e}")
+                logger.error("Ошибка при нарезке файла: %s", e)
                 raise  # Пробрасываем исключение дальше
 
         cut_audio()